@@ -1,33 +1,53 @@
+import collections
 import datetime
+import gc
+import hashlib
 import logging
 import os
 import warnings
 from argparse import ArgumentParser, Namespace
-from typing import Dict, Generator, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Generator, List, Tuple, Union
 import time
 
 from datasets import Dataset, disable_caching
-from multiprocess import current_process
+from multiprocess import Manager, current_process
 from newsplease.crawler.commoncrawl_crawler import __get_remote_index
 from tqdm import tqdm
 
 from datasets_news_please.extractor import IterableCommonCrawlExtractor
-from datasets_news_please.utils import CC_BASE_BUCKET, get_remote_index
+from datasets_news_please.utils import (
+    ARTICLE_FIELDS,
+    CC_BASE_BUCKET,
+    INDEX_CACHE_TTL,
+    KEYS_TO_KEEP,
+    evict_cached_articles,
+    get_cached_remote_index,
+    get_remote_index,
+    interleave_warc_paths,
+    load_cached_articles,
+    save_cached_articles,
+)
 
 
 # disable datasets caching
 disable_caching()
 
-# avoid reusing previously downloaded warcs that may be corrupted
-os.environ['REUSE_DATASET_IF_EXISTS'] = '0'
-
 # logging
 logger = logging.getLogger('datasets_news_please')
 
 # suppress all warning from BeautifoulSoup and others
 warnings.filterwarnings("ignore")
 
-DEFAULT_TEMP_DIR = '/tmp/datasets_news_please/'
+# keep downloaded warcs in RAM when a tmpfs is available, they are read only once right after the download
+SHM_DIR = '/dev/shm'
+FALLBACK_TEMP_DIR = '/tmp/datasets_news_please/'
+DEFAULT_TEMP_DIR = os.path.join(SHM_DIR, 'datasets_news_please/') if os.path.isdir(SHM_DIR) else FALLBACK_TEMP_DIR
+# CC-News warc files are about 1GB each
+WARC_FILE_SIZE = 1024 ** 3
+
+# extraction allocates many short-lived objects, collect garbage less often in the workers
+GC_THRESHOLDS = (50_000, 20, 20)
 LOGGING_STR_TO_ID = dict(
     debug=logging.DEBUG,
     info=logging.INFO,
@@ -36,26 +56,85 @@ LOGGING_STR_TO_ID = dict(
 )
 
 
+def get_cache_filepath(
+    cache_directory: str,
+    warc_path: str,
+    include_hosts: List[str] = None,
+    exclude_hosts: List[str] = None,
+    start_date: Union[datetime.datetime, int] = None,
+    end_date: Union[datetime.datetime, int] = None,
+    language: str = 'en',
+    strict_date: bool = False,
+    fetch_images: bool = False,
+    limit: int = None,
+    fields: Tuple[str] = KEYS_TO_KEEP,
+    **kwargs,
+) -> str:
+    r""" Path of the file caching the articles extracted from a warc file with the given filters. """
+    cache_key = repr((
+        warc_path, include_hosts, exclude_hosts, start_date, end_date, language, strict_date, fetch_images, limit,
+        fields,
+    ))
+    return os.path.join(cache_directory, f"{hashlib.blake2b(cache_key.encode()).hexdigest()}.arrow")
+
+
 def extraction_function(
     warc_path: str = None,
     include_hosts: List[str] = None,
     exclude_hosts: List[str] = None,
-    start_date: datetime.datetime = None,
-    end_date: datetime.datetime = None,
+    start_date: Union[datetime.datetime, int] = None,
+    end_date: Union[datetime.datetime, int] = None,
     language: str = 'en',
     strict_date: bool = False,
     fetch_images: bool = False,
     limit: int = None,
+    fields: Tuple[str] = KEYS_TO_KEEP,
     temporary_directory: str = DEFAULT_TEMP_DIR,
     process_id: int = 0,
     bucket_name: str = CC_BASE_BUCKET,
+    download_semaphore=None,
+    stream: bool = True,
+    decompression_threads: int = 1,
+    keep_warcs: bool = False,
+    cache_directory: str = None,
+    cache_max_size: int = None,
+    local_path_name: str = None,
 ) -> Generator[Dict, None, None]:
-    r""" Extract a single warc files and return results as a list of dictionaries. """
+    r""" Extract a single warc files and return results as a list of dictionaries.
+    If `cache_directory` is given, results are saved there and reused by later calls with the same arguments.
+    If `local_path_name` is given, the warc file has already been downloaded there. """
+
+    if cache_directory is not None:
+        cache_filepath = get_cache_filepath(
+            cache_directory,
+            warc_path,
+            include_hosts=include_hosts,
+            exclude_hosts=exclude_hosts,
+            start_date=start_date,
+            end_date=end_date,
+            language=language,
+            strict_date=strict_date,
+            fetch_images=fetch_images,
+            limit=limit,
+            fields=fields,
+        )
+
+        if os.path.exists(cache_filepath):
+            logger.debug(f'using cached articles {cache_filepath} for {warc_path}')
+            yield from load_cached_articles(cache_filepath)
+            return
 
     commoncrawl_extractor = IterableCommonCrawlExtractor(
-        temporary_directory, process_id=process_id, bucket_name=bucket_name
+        temporary_directory,
+        process_id=process_id,
+        bucket_name=bucket_name,
+        download_semaphore=download_semaphore,
+        stream=stream,
+        decompression_threads=decompression_threads,
+        keep_warcs=keep_warcs,
     )
-    yield from commoncrawl_extractor.extract_from_commoncrawl(
+    articles = []
+    for article in commoncrawl_extractor.extract_from_commoncrawl(
         warc_path,
         include_hosts=include_hosts,
         exclude_hosts=exclude_hosts,
@@ -65,10 +144,35 @@ def extraction_function(
         strict_date=strict_date,
         fetch_images=fetch_images,
         limit=limit,
-    )
-
-
-def processor(warc_paths: List[str] = [], delay: int = 30, **kwargs) -> Generator[Dict, None, None]:
+        fields=fields,
+        local_path_name=local_path_name,
+    ):
+        if cache_directory is not None:
+            articles.append(article)
+        yield article
+
+    # reached only if the whole warc file was extracted
+    if cache_directory is not None:
+        os.makedirs(cache_directory, exist_ok=True)
+        try:
+            save_cached_articles(cache_filepath, articles)
+        except Exception:
+            logger.warning(f'Could not cache articles extracted from {warc_path}', exc_info=True)
+        if cache_max_size is not None:
+            evict_cached_articles(cache_directory, cache_max_size)
+
+
+def processor(
+    warc_paths: List[str] = [],
+    temporary_directory: str = DEFAULT_TEMP_DIR,
+    bucket_name: str = CC_BASE_BUCKET,
+    download_semaphore=None,
+    stream: bool = True,
+    cache_directory: str = None,
+    pin_cpu: bool = False,
+    prefetch_warcs: int = 1,
+    **kwargs,
+) -> Generator[Dict, None, None]:
     r""" Takes a list of warc files. Start multiprocessing pool, update a progress bar
     and returns an iterable of dictionaries containing the new articles examples. """
     # run the crawler in the current, single process if number of extraction processes is set to 1
@@ -78,18 +182,82 @@ def processor(warc_paths: List[str] = [], delay: int = 30, **kwargs) -> Generato
     # position progress bar on top of all extraction processes
     position = process_id + 1
 
-    delay *= process_id
-    logging.info(f"Process {process_id} sleeping {delay} seconds...")
-    time.sleep(delay)
+    gc.set_threshold(*GC_THRESHOLDS)
 
-    for warc_path in tqdm(
-        warc_paths,
-        desc=f'Progress {process_id}',
-        unit='warcs',
-        smoothing=0.2,
-        position=position,
-    ):
-        yield from extraction_function(warc_path, **kwargs, process_id=process_id)
+    # pin each extraction process to a different cpu
+    if pin_cpu and process_id > 0 and hasattr(os, 'sched_setaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cpus[(process_id - 1) % len(cpus)]})
+
+    # download the next `prefetch_warcs` warc files in background while extracting articles from the current one
+    downloader = IterableCommonCrawlExtractor(
+        temporary_directory,
+        process_id=process_id,
+        bucket_name=bucket_name,
+        download_semaphore=download_semaphore,
+        stream=stream,
+    )
+
+    def prefetch(warc_path: str) -> str:
+        if downloader.streaming:
+            return None
+        if cache_directory is not None and os.path.exists(get_cache_filepath(cache_directory, warc_path, **kwargs)):
+            return None
+        return downloader.download_warc(warc_path)
+
+    limit = kwargs.get('limit', None)
+    extracted = 0
+
+    with ThreadPoolExecutor(max_workers=prefetch_warcs) as prefetcher:
+        next_local_path_names = collections.deque(
+            prefetcher.submit(prefetch, warc_path) for warc_path in warc_paths[:prefetch_warcs]
+        )
+        local_path_name = None
+
+        try:
+            for index, warc_path in enumerate(tqdm(
+                warc_paths,
+                desc=f'Progress {process_id}',
+                unit='warcs',
+                smoothing=0.2,
+                position=position,
+            )):
+                local_path_name = next_local_path_names.popleft().result()
+                if index + prefetch_warcs < len(warc_paths):
+                    next_local_path_names.append(prefetcher.submit(prefetch, warc_paths[index + prefetch_warcs]))
+
+                for article in extraction_function(
+                    warc_path,
+                    **kwargs,
+                    temporary_directory=temporary_directory,
+                    process_id=process_id,
+                    bucket_name=bucket_name,
+                    download_semaphore=download_semaphore,
+                    stream=stream,
+                    cache_directory=cache_directory,
+                    local_path_name=local_path_name,
+                ):
+                    yield article
+
+                    # stop as soon as enough articles were extracted, without opening the remaining warc files
+                    extracted += 1
+                    if limit is not None and extracted >= limit:
+                        logger.info(f'Processor {process_id} reached the limit of {limit} articles...')
+                        return
+
+        finally:
+            # remove the warc files downloaded but not fully extracted, e.g. after reaching the limit or on errors
+            for next_local_path_name in next_local_path_names:
+                next_local_path_name.cancel()
+            if not kwargs.get('keep_warcs', False):
+                leftovers = [local_path_name]
+                for next_local_path_name in next_local_path_names:
+                    if not next_local_path_name.cancelled() and next_local_path_name.exception() is None:
+                        leftovers.append(next_local_path_name.result())
+                for leftover in leftovers:
+                    if leftover is not None and os.path.exists(leftover):
+                        logger.debug(f'removing not extracted warc {leftover}')
+                        os.remove(leftover)
 
     logger.info(f'Processor {process_id} finished successfully...')
 
@@ -100,20 +268,58 @@ def main(args: Namespace):
     logger.setLevel(LOGGING_STR_TO_ID[args.logging_level])
 
     logger.info('Starting Datasets CC-News Extractor...')
+
+    assert args.prefetch_warcs >= 1, "at least one warc file must be prefetched"
+
+    if args.keep_warcs and not args.download_warcs:
+        logger.warning('--keep_warcs has no effect without --download_warcs, streamed warc files are never saved')
+
+    # kept warc files accumulate across runs and would fill the memory backed tmpfs, they are saved to disk
+    if args.keep_warcs and args.temp_warc_dir == DEFAULT_TEMP_DIR and DEFAULT_TEMP_DIR != FALLBACK_TEMP_DIR:
+        logger.info(f'Keeping warc files in {FALLBACK_TEMP_DIR} instead of {SHM_DIR}')
+        args.temp_warc_dir = FALLBACK_TEMP_DIR
+
+    # fall back to disk if the tmpfs cannot hold the current and the prefetched warc files of each worker
+    if args.temp_warc_dir == DEFAULT_TEMP_DIR and DEFAULT_TEMP_DIR != FALLBACK_TEMP_DIR:
+        shm_stats = os.statvfs(SHM_DIR)
+        warc_files_per_worker = 1 + args.prefetch_warcs
+        if shm_stats.f_bavail * shm_stats.f_frsize < warc_files_per_worker * (args.num_workers or 1) * WARC_FILE_SIZE:
+            logger.info(f'Not enough space available in {SHM_DIR}, using {FALLBACK_TEMP_DIR}')
+            args.temp_warc_dir = FALLBACK_TEMP_DIR
+
     logger.info(f'Temporary download directory for warc files: {args.temp_warc_dir}')
 
     os.makedirs(args.temp_warc_dir, exist_ok=True)
     assert not os.path.exists(args.output_folder)
 
-    article_start_date = datetime.datetime.strptime(args.article_start_date, '%Y-%m-%d') if args.article_start_date else None  # noqa: E501
-    article_end_date = datetime.datetime.strptime(args.article_end_date, '%Y-%m-%d') if args.article_end_date else None
+    # with a cache, an interrupted run can be resumed without extracting again the warc files already completed
+    if args.cache_dir is not None and os.path.exists(args.cache_dir):
+        logger.info(f'Reusing articles cached in {args.cache_dir}')
+
+    # article dates are passed to the workers as unix timestamps
+    article_start_date = int(datetime.datetime.strptime(args.article_start_date, '%Y-%m-%d').timestamp()) if args.article_start_date else None  # noqa: E501
+    article_end_date = int(datetime.datetime.strptime(args.article_end_date, '%Y-%m-%d').timestamp()) if args.article_end_date else None  # noqa: E501
 
     warc_start_date = datetime.datetime.strptime(args.warc_start_date, '%Y-%m-%d') if args.warc_start_date else None
     warc_end_date = datetime.datetime.strptime(args.warc_end_date, '%Y-%m-%d') if args.warc_end_date else None
 
     logger.info('Getting listing of WARC files.')
-    cc_news_crawl_names = get_remote_index(warc_files_start_date=warc_start_date, warc_files_end_date=warc_end_date, bucket_name=args.bucket_name)
+    if args.index_cache_ttl > 0:
+        cc_news_crawl_names = get_cached_remote_index(
+            os.path.join(args.temp_warc_dir, '.index_cache'),
+            warc_files_start_date=warc_start_date,
+            warc_files_end_date=warc_end_date,
+            bucket_name=args.bucket_name,
+            ttl=args.index_cache_ttl,
+        )
+    else:
+        cc_news_crawl_names = get_remote_index(
+            warc_files_start_date=warc_start_date, warc_files_end_date=warc_end_date, bucket_name=args.bucket_name
+        )
     logger.info(f'Found {len(cc_news_crawl_names)} WARC files.')
+    cc_news_crawl_names = interleave_warc_paths(
+        cc_news_crawl_names, num_workers=args.num_workers, chunksize=args.chunksize
+    )
 
     logger.info(f'Creating extraction process pool with {args.num_workers} processes...')
     logger.info('Starting dataset generation...')
@@ -126,25 +332,49 @@ def main(args: Namespace):
     if args.exclude_hosts is not None:
         args.exclude_hosts = tuple(args.exclude_hosts)
 
-    dataset = Dataset.from_generator(
-        processor,
-        keep_in_memory=False,
-        gen_kwargs=dict(
-            warc_paths=cc_news_crawl_names,
-            include_hosts=args.include_hosts,
-            exclude_hosts=args.exclude_hosts,
-            start_date=article_start_date,
-            end_date=article_end_date,
-            language=args.language,
-            strict_date=args.article_strict_date,
-            temporary_directory=args.temp_warc_dir,
-            fetch_images=args.fetch_images,
-            limit=args.limit,
-            delay=args.delay,
-            bucket_name=args.bucket_name,
-        ),
-        num_proc=args.num_workers,
-    )
+    # move objects created so far out of the collected generations, garbage collections in the forked workers
+    # will not touch them and copy their pages
+    gc.freeze()
+
+    # share the cpus between the workers to decompress downloaded warc files
+    decompression_threads = args.decompression_threads
+    if decompression_threads is None:
+        decompression_threads = max(1, (os.cpu_count() or 1) // (args.num_workers or 1))
+
+    # limit concurrent downloads across all processes
+    with Manager() as manager:
+        download_semaphore = None
+        if args.max_concurrent_downloads is not None:
+            download_semaphore = manager.BoundedSemaphore(args.max_concurrent_downloads)
+
+        dataset = Dataset.from_generator(
+            processor,
+            keep_in_memory=False,
+            gen_kwargs=dict(
+                warc_paths=cc_news_crawl_names,
+                include_hosts=args.include_hosts,
+                exclude_hosts=args.exclude_hosts,
+                start_date=article_start_date,
+                end_date=article_end_date,
+                language=args.language,
+                strict_date=args.article_strict_date,
+                temporary_directory=args.temp_warc_dir,
+                fetch_images=args.fetch_images,
+                limit=args.limit,
+                fields=tuple(args.fields),
+                download_semaphore=download_semaphore,
+                stream=not args.download_warcs,
+                keep_warcs=args.keep_warcs,
+                decompression_threads=decompression_threads,
+                bucket_name=args.bucket_name,
+                cache_directory=args.cache_dir,
+                cache_max_size=int(args.cache_max_size * 1024 ** 3) if args.cache_max_size is not None else None,
+                pin_cpu=args.pin_cpu,
+                prefetch_warcs=args.prefetch_warcs,
+            ),
+            num_proc=args.num_workers,
+            writer_batch_size=args.writer_batch_size,
+        )
 
     logger.info(f'Finished generating dataset containing {len(dataset)} examples.')
     logger.info('Saving to disk...')
@@ -170,9 +400,28 @@ if __name__ == "__main__":
     # fetch also images
     parser.add_argument('--fetch_images', action="store_true")
 
+    # fields of the articles to keep
+    parser.add_argument(
+        '--fields', type=str, nargs='+', required=False, default=KEYS_TO_KEEP, choices=ARTICLE_FIELDS,
+        help="Article fields to keep."
+    )
+
     # fetch also images
     parser.add_argument('--limit', type=int, required=False, default=None, help="Limit extracted articles per process")
 
+    # cache extracted articles
+    parser.add_argument(
+        '--cache_dir', type=str, required=False, default=None,
+        help=(
+            "Save articles extracted from each WARC file here and reuse them in later runs with the same filters, "
+            "e.g. to resume an interrupted run. Disabled by default."
+        )
+    )
+    parser.add_argument(
+        '--cache_max_size', type=float, required=False, default=None,
+        help="Maximum size of the cache in GB, least recently used files are removed first."
+    )
+
     # filter WARC file date
     parser.add_argument('--warc_start_date', type=str, required=False, default=None, help="Date as YYYY-MM-DD")
     parser.add_argument('--warc_end_date', type=str, required=False, default=None, help="Date as YYYY-MM-DD")
@@ -180,10 +429,51 @@ if __name__ == "__main__":
     # filter language
     parser.add_argument('--language', type=str, required=False, default=None)
     parser.add_argument('--bucket_name', type=str, required=False, default=CC_BASE_BUCKET)
+    parser.add_argument(
+        '--download_warcs', action="store_true",
+        help="Download WARC files to temp_warc_dir instead of reading them directly from S3 or over HTTPS."
+    )
+    parser.add_argument(
+        '--prefetch_warcs', type=int, required=False, default=1,
+        help="Number of WARC files downloaded in background by each worker while extracting the current one."
+    )
+    parser.add_argument(
+        '--keep_warcs', action="store_true",
+        help=(
+            "Keep downloaded WARC files in temp_warc_dir and reuse them in later runs, only with --download_warcs. "
+            "The default temp_warc_dir is moved from /dev/shm to disk."
+        )
+    )
+    parser.add_argument(
+        '--index_cache_ttl', type=int, required=False, default=INDEX_CACHE_TTL,
+        help="Seconds for which the listing of WARC files is reused across runs, 0 disables the cache."
+    )
 
     # mixed arguments
     parser.add_argument('--num_workers', type=int, required=False, default=None)
+    parser.add_argument(
+        '--chunksize', type=int, required=False, default=None,
+        help=(
+            "Number of consecutive WARC files assigned to a worker at a time. "
+            "Defaults to min(32, files // (workers * 4))."
+        )
+    )
+    parser.add_argument(
+        '--writer_batch_size', type=int, required=False, default=None,
+        help="Override the number of articles buffered by each worker before being written to the dataset."
+    )
+    parser.add_argument(
+        '--decompression_threads', type=int, required=False, default=None,
+        help="Threads used by each worker to decompress downloaded WARC files. Defaults to CPUs // workers."
+    )
+    parser.add_argument('--pin_cpu', action="store_true", help="Pin each worker to a different CPU (Linux only).")
     parser.add_argument('--logging_level', type=str, default='info', choices=('info', 'debug', 'warning', 'error'))
-    parser.add_argument('--delay', type=int, default=20, required=False, help="Delay start of processing.")
+    parser.add_argument(
+        '--max_concurrent_downloads', type=int, default=8, required=False,
+        help=(
+            "Maximum number of WARC files downloaded, or range requests of streamed files, "
+            "at the same time by all processes."
+        )
+    )
     args = parser.parse_args()
     main(args)
@@ -1,21 +1,29 @@
+import contextlib
 import datetime
 import logging
 import os
 import sys
-from typing import Dict, Generator, List
+import urllib.parse
+from typing import Dict, Generator, List, Tuple, Union
 import jieba
 import boto3
 from newsplease.crawler.commoncrawl_extractor import EmptyResponseError, configure_logging
-from tqdm import tqdm
-from warcio.archiveiterator import ArchiveIterator
-import botocore
 
 from datasets_news_please.utils import (
     CC_BASE_BUCKET,
+    KEYS_TO_KEEP,
+    build_hosts_trie,
     download,
+    drop_cached_pages,
     from_warc,
+    get_declared_language,
     get_publishing_date,
     get_publishing_language,
+    get_s3_client,
+    iterate_warc_records,
+    match_host,
+    open_remote_stream,
+    open_warc_file,
     on_valid_article_extracted,
 )
 
@@ -46,8 +54,11 @@ class IterableCommonCrawlExtractor:
     # hosts (if None or empty list, any host is OK)
     filter_include_hosts = None  # example: ['elrancaguino.cl']
     filter_exclude_hosts = None  # example: ['elrancaguino.cl']
+    # tries of the hosts above, a host also matches all its subdomains
+    filter_include_hosts_trie = None
+    filter_exclude_hosts_trie = None
 
-    # start and end date (if None, any date is OK), as datetime
+    # start and end date (if None, any date is OK), as unix timestamps
     # if date filtering is string, e.g., if we could not detect the date of an article, we will discard the article
     filter_start_date = None
     filter_end_date = None
@@ -59,54 +70,62 @@ class IterableCommonCrawlExtractor:
     # limit extracted articles for debugging
     limit = None
 
-    def __init__(self, temporary_directory: str = None, process_id: int = None, bucket_name: str = CC_BASE_BUCKET):
-        r""" Crawl and extract articles form the news crawl provided by commoncrawl.org. """
+    # fields of the articles to keep
+    fields = KEYS_TO_KEEP
+
+    def __init__(
+        self,
+        temporary_directory: str = None,
+        process_id: int = None,
+        bucket_name: str = CC_BASE_BUCKET,
+        download_semaphore=None,
+        stream: bool = True,
+        decompression_threads: int = 1,
+        keep_warcs: bool = False,
+    ):
+        r""" Crawl and extract articles form the news crawl provided by commoncrawl.org.
+        If given, `download_semaphore` is held while downloading, or during each range request when streaming,
+        to limit concurrent downloads across processes.
+        If `stream` is True, warc files are read without being downloaded, from S3 if the bucket is accessible,
+        otherwise over HTTPS.
+        Downloaded warc files are decompressed with `decompression_threads` threads and removed after
+        extraction, unless `keep_warcs` is True. """
 
         self.temporary_directory = temporary_directory
         os.makedirs(self.temporary_directory, exist_ok=True)
         self.process_id = process_id
         self.bucket_name = bucket_name
+        self.download_semaphore = download_semaphore
+        self.stream = stream
+        self.decompression_threads = decompression_threads
+        self.keep_warcs = keep_warcs
 
-        s3_client = boto3.client('s3')
-        # Verify access to commoncrawl bucket
-        try:
-            s3_client.head_bucket(Bucket=self.bucket_name)
-            self.s3_client = s3_client
-        except (botocore.exceptions.ClientError, botocore.exceptions.NoCredentialsError):
-            logger.info(f'Failed to read {self.bucket_name} bucket, using monthly WARC file listings')
-            self.s3_client = None
+        self.s3_client = get_s3_client(self.bucket_name)
 
     def filter_record(self, warc_record, article=None):
         r"""
-        Returns true if a record passes all tests: hosts, publishing date
+        Returns true if a record passes all tests: hosts, publishing date, language
         :param warc_record:
-        :return: A tuple of (True or False) and an article (might be None)
+        :return: A tuple of (True or False) and an article, None if no filter needed to parse it
         """
 
-        # filter by host
-        if self.filter_include_hosts:
+        # filter by host, comparing the host name of the WARC transaction Target URI, so that something like
+        # g.co?forward_url=facebook.com does not yield a positive filter test for facebook.com
+        if self.filter_include_hosts or self.filter_exclude_hosts:
             url = warc_record.rec_headers.get_header('WARC-Target-URI')
+            host = urllib.parse.urlsplit(url).hostname or ''
 
-            # very simple check, check if one of the required host names is contained in the url of the WARC transaction
-            # better would be to extract the host name from the WARC transaction Target URI and then check for equality
-            # because currently something like g.co?forward_url=facebook.com would yield a positive filter test for
-            # facebook.com even though the actual host is g.co
-            for valid_host in self.filter_include_hosts:
-                if valid_host in url:
-                    break
-            else:
+            if self.filter_include_hosts and not match_host(host, self.filter_include_hosts_trie):
                 return False, article
 
-        if self.filter_exclude_hosts:
-            url = warc_record.rec_headers.get_header('WARC-Target-URI')
+            if self.filter_exclude_hosts and match_host(host, self.filter_exclude_hosts_trie):
+                return False, article
 
-            # very simple check, check if one of the required host names is contained in the url of the WARC transaction
-            # better would be to extract the host name from the WARC transaction Target URI and then check for equality
-            # because currently something like g.co?forward_url=facebook.com would yield a positive filter test for
-            # facebook.com even though the actual host is g.co
-            for invalid_host in self.filter_exclude_hosts:
-                if invalid_host in url:
-                    return False, article
+        # filter on the declared language, much cheaper than parsing the article
+        if self.filter_on_language and not article:
+            declared_language = get_declared_language(warc_record)
+            if declared_language is not None and declared_language != self.filter_on_primary_language:
+                return False, article
 
         # filter by date
         if self.filter_start_date or self.filter_end_date:
@@ -119,9 +138,10 @@ class IterableCommonCrawlExtractor:
                     return False, article
             else:  # here we for sure have a date
                 # is article published too early?
-                if self.filter_start_date and publishing_date < self.filter_start_date:
+                publishing_timestamp = publishing_date.timestamp()
+                if self.filter_start_date and publishing_timestamp < self.filter_start_date:
                     return False, article
-                if self.filter_end_date and publishing_date > self.filter_end_date:
+                if self.filter_end_date and publishing_timestamp > self.filter_end_date:
                     return False, article
 
         # filter on language
@@ -130,104 +150,135 @@ class IterableCommonCrawlExtractor:
                 article = from_warc(warc_record, fetch_images=self.fetch_images)
             original_language = get_publishing_language(warc_record, article)
 
-            if not original_language:
+            # article without a language or published in another language
+            if not original_language or (
+                self.filter_on_language and original_language.lower() != self.filter_on_language_lower
+            ):
                 return False, article
 
-            else:  # here we for sure have a language
-                # is article published in another language
-                if self.filter_on_language and original_language != self.filter_on_language:
-                    return False, article
-
         return True, article
 
-    def process_warc_gz_file(self, path_name: str) -> Generator[Dict, None, None]:
-        r""" Iterates all transactions in one WARC file and for each transaction tries to extract an article object.
+    def process_warc_stream(self, stream) -> Generator[Dict, None, None]:
+        r""" Iterates all transactions in one WARC stream and for each transaction tries to extract an article object.
         Returns a generator of newly extracted documents. """
-    
-        position = self.process_id + 1
-
-        with open(path_name, 'rb') as stream:
-            for index, record in tqdm(
-                enumerate(ArchiveIterator(stream)),
-                desc=f"Extraction {self.process_id}",
-                unit="articles",
-                position=position,
-                disable=True,
-            ):
+        for index, record in enumerate(iterate_warc_records(stream)):
+            try:
+                # if the article passes filter tests, we notify the user
                 try:
-                    if record.rec_type == 'response':
-                        # if the article passes filter tests, we notify the user
-                        try:
-                            filter_pass, article = self.filter_record(record)
-                        except (UnicodeDecodeError, EmptyResponseError):
-                            filter_pass = False
-                            article = None
-
-                        if filter_pass:
-                            try:
-                                if not article:
-                                    article = from_warc(record, fetch_images=self.fetch_images)
-                            except (UnicodeDecodeError, EmptyResponseError):
-                                filter_pass = False
-
-                        if filter_pass:
-                            logger.debug(
-                                f'article pass ({article.source_domain}; {article.date_publish}; {article.title})'
-                            )
-                            article = on_valid_article_extracted(article)
-                            yield article
-                        else:
-                            if article:
-                                logger.debug(
-                                    f'article discard ({article.source_domain}; '
-                                    f'{article.date_publish}; {article.title})'
-                                )
-                            else:
-                                logger.debug(f'article discard ({record.rec_headers.get_header("WARC-Target-URI")})')
-
-                except:  # noqa E722
-                    logger.warning(f'Unexpected error extracting article: {sys.exc_info()[0]} ({sys.exc_info()[1]})')
-                    logger.warning(sys.exc_info()[2], exc_info=True)
-
-                finally:
-                    if self.limit is not None and index >= self.limit:
-                        break
+                    filter_pass, article = self.filter_record(record)
+                except (UnicodeDecodeError, EmptyResponseError):
+                    filter_pass = False
+                    article = None
+
+                if filter_pass:
+                    try:
+                        # the filter returns the article only if it had to parse it
+                        article = article or from_warc(record, fetch_images=self.fetch_images)
+                    except (UnicodeDecodeError, EmptyResponseError):
+                        filter_pass = False
+
+                if filter_pass:
+                    logger.debug(
+                        f'article pass ({article.source_domain}; {article.date_publish}; {article.title})'
+                    )
+                    article = on_valid_article_extracted(article, keys=self.fields)
+                    yield article
+                else:
+                    if article:
+                        logger.debug(
+                            f'article discard ({article.source_domain}; '
+                            f'{article.date_publish}; {article.title})'
+                        )
+                    else:
+                        logger.debug(f'article discard ({record.rec_headers.get_header("WARC-Target-URI")})')
+
+            except Exception:
+                # GeneratorExit is not caught, so that consumers stopping early can close the generator
+                logger.warning(f'Unexpected error extracting article: {sys.exc_info()[0]} ({sys.exc_info()[1]})')
+                logger.warning(sys.exc_info()[2], exc_info=True)
+
+            if self.limit is not None and index >= self.limit:
+                break
+
+    def process_warc_gz_file(self, path_name: str) -> Generator[Dict, None, None]:
+        r""" Extracts articles from a downloaded WARC file and removes it afterwards, unless keeping warc files. """
+        with open_warc_file(path_name, parallelization=self.decompression_threads) as stream:
+            yield from self.process_warc_stream(stream)
 
         # cleanup
-        logger.debug(f'removing fully extracted warc {path_name}')
-        os.remove(path_name)
+        if not self.keep_warcs:
+            logger.debug(f'removing fully extracted warc {path_name}')
+            os.remove(path_name)
+        else:
+            # kept files should not evict more useful pages from the page cache
+            drop_cached_pages(path_name)
+
+    @property
+    def streaming(self) -> bool:
+        r""" Whether warc files are read directly from S3 or over HTTPS instead of being downloaded first. """
+        return self.stream
+
+    def download_warc(self, warc_path: str) -> str:
+        r""" Download a warc file in the temporary directory and return the local path. """
+        with self.download_semaphore or contextlib.nullcontext():
+            return download(
+                warc_path,
+                self.temporary_directory,
+                position=self.process_id + 1,
+                s3_client=self.s3_client,
+                bucket_name=self.bucket_name,
+            )
 
     def extract_from_commoncrawl(
         self,
         warc_path: str,
         include_hosts: List[str] = None,
         exclude_hosts: List[str] = None,
-        start_date: datetime.datetime = None,
-        end_date: datetime.datetime = None,
+        start_date: Union[datetime.datetime, int] = None,
+        end_date: Union[datetime.datetime, int] = None,
         language: str = 'en',
         strict_date: bool = False,
         fetch_images: bool = False,
         limit: int = None,
+        fields: Tuple[str] = KEYS_TO_KEEP,
+        local_path_name: str = None,
     ) -> Generator[Dict, None, None]:
-        r""" Crawl and extract articles form the news crawl provided by commoncrawl.org. """
+        r""" Crawl and extract articles form the news crawl provided by commoncrawl.org.
+        The warc file is downloaded first unless `local_path_name` points to an already downloaded copy. """
         self.warc_path = warc_path
         self.filter_include_hosts = include_hosts
         self.filter_exclude_hosts = exclude_hosts
+        self.filter_include_hosts_trie = build_hosts_trie(include_hosts)
+        self.filter_exclude_hosts_trie = build_hosts_trie(exclude_hosts)
 
+        if isinstance(start_date, datetime.datetime):
+            start_date = start_date.timestamp()
+        if isinstance(end_date, datetime.datetime):
+            end_date = end_date.timestamp()
         self.filter_start_date = start_date
         self.filter_end_date = end_date
         self.filter_on_language = language
+        self.filter_on_language_lower = language.lower() if language else None
+        self.filter_on_primary_language = self.filter_on_language_lower.split('-')[0] if language else None
         self.filter_strict_date = strict_date
 
         self.fetch_images = fetch_images
 
         self.limit = limit
-
-        local_path_name = download(
-            self.warc_path,
-            self.temporary_directory,
-            position=self.process_id + 1,
-            s3_client=self.s3_client,
-            bucket_name=self.bucket_name,
-        )
+        self.fields = tuple(fields)
+
+        if local_path_name is None and self.streaming:
+            logger.info(f"Streaming file {self.warc_path} {'from S3' if self.s3_client is not None else 'with HTTPS'}")
+            # range requests count as downloads, the extraction itself is not limited
+            with open_remote_stream(
+                self.warc_path,
+                s3_client=self.s3_client,
+                bucket_name=self.bucket_name,
+                semaphore=self.download_semaphore,
+            ) as stream:
+                yield from self.process_warc_stream(stream)
+            return
+
+        if local_path_name is None:
+            local_path_name = self.download_warc(self.warc_path)
         yield from self.process_warc_gz_file(local_path_name)
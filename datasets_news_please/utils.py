@@ -1,22 +1,58 @@
-# import hashlib
+import collections
+import contextlib
+import datetime
+import functools
+import hashlib
+import io
+import json
 import logging
+import operator
 import os
+import random
+import re
+import shutil
+import threading
 import time
 import urllib
 import urllib.parse
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
 import boto3
+import boto3.s3.transfer
 import botocore
+import botocore.config
 import gzip
 
+import pyarrow as pa
 import requests
+import requests.adapters
 from dateutil import parser
-from newsplease.crawler.commoncrawl_crawler import (
-    __iterate_by_month, __date_within_period, __extract_date_from_warc_filename
-)
+from newsplease.crawler.commoncrawl_crawler import __common_crawl_start_date, __iterate_by_month
 from newsplease.crawler.commoncrawl_extractor import NewsPlease
+from warcio.archiveiterator import ArchiveIterator
 
 from tqdm import tqdm
+from urllib3.util.retry import Retry
+
+
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+
+try:
+    from fastwarc.warc import ArchiveIterator as FastWarcArchiveIterator
+    from fastwarc.warc import WarcRecordType
+except ImportError:
+    FastWarcArchiveIterator = None
+
+# parse warc files with fastwarc if available, set USE_FASTWARC=0 to use warcio
+USE_FASTWARC = FastWarcArchiveIterator is not None and os.environ.get('USE_FASTWARC', '1') != '0'
 
 
 # set own logger
@@ -26,6 +62,60 @@ logger = logging.getLogger('datasets_news_please')
 CC_BASE_URL = 'https://data.commoncrawl.org'
 CC_BASE_BUCKET = 'commoncrawl'
 
+# maximum default number of consecutive warc files assigned to a worker
+MAX_CHUNKSIZE = 32
+
+# remote warc files are streamed with concurrent range requests of this size
+STREAM_CHUNK_SIZE = 16 * 1024 * 1024
+STREAM_PREFETCH = 4
+
+# downloads from s3 are split in this many concurrent range requests of STREAM_CHUNK_SIZE bytes
+S3_MAX_CONCURRENCY = 16
+S3_TRANSFER_CONFIG = boto3.s3.transfer.TransferConfig(
+    multipart_threshold=STREAM_CHUNK_SIZE,
+    multipart_chunksize=STREAM_CHUNK_SIZE,
+    max_concurrency=S3_MAX_CONCURRENCY,
+)
+
+# how long a cached listing of warc files remains valid, in seconds
+INDEX_CACHE_TTL = 6 * 60 * 60
+
+# monthly listings of warc files are fetched concurrently by this many threads
+LISTING_THREADS = 16
+
+# shared https session keeping connections alive across calls and threads, failed requests are retried
+# with exponential backoff honouring Retry-After, the last response is returned if all retries fail
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount('https://', requests.adapters.HTTPAdapter(
+    pool_maxsize=LISTING_THREADS,
+    max_retries=Retry(
+        total=8,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(('GET', 'HEAD')),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    ),
+))
+# connections opened before forking must not be shared with the child processes
+os.register_at_fork(after_in_child=HTTP_SESSION.close)
+
+# extended attribute storing the ETag of the remote file with downloaded files
+ETAG_XATTR = 'user.datasets_news_please.etag'
+
+# warc files are named after their creation time, e.g. CC-NEWS-20160911145202-00018.warc.gz
+WARC_TIMESTAMP_FORMAT = '%Y%m%d%H%M%S'
+# timestamp of warc files with unexpected names, clearly outside any period
+INVALID_WARC_TIMESTAMP = '19000101000000'
+
+# language declared by html pages, e.g. <html lang="en-US">, only the beginning of the page is searched
+HTML_LANG_PATTERN = re.compile(
+    rb'<html\b[^>]*?(?<![\w-])lang\s*=\s*["\']?([a-zA-Z]{2,3})(?![a-zA-Z0-9])', re.IGNORECASE
+)
+HTML_LANG_SEARCH_SIZE = 4096
+# language declared in the Content-Language header, e.g. en, en-US or en_US, other values are ignored
+CONTENT_LANGUAGE_PATTERN = re.compile(r'([a-zA-Z]{2,3})(?:[-_][a-zA-Z0-9]+)*')
+
 # what to keep from downloaded articles
 KEYS_TO_KEEP = (
     "date_download",
@@ -41,6 +131,154 @@ KEYS_TO_KEEP = (
     "image_url",
 )
 
+# all the fields of the articles extracted by news-please
+ARTICLE_FIELDS = KEYS_TO_KEEP + (
+    "filename",
+    "localpath",
+    "title_rss",
+    "url",
+)
+
+
+class FastWarcHeaders(object):
+    r""" Expose fastwarc headers through the `get_header` interface of warcio. """
+
+    def __init__(self, headers):
+        self.headers = headers
+
+    def get_header(self, name: str, default: str = None) -> str:
+        return self.headers.get(name, default)
+
+
+class FastWarcRecord(object):
+    r""" Wrap a fastwarc record with the attributes of warcio records used by news-please. """
+
+    def __init__(self, record):
+        self.rec_type = 'response' if record.record_type == WarcRecordType.response else str(record.record_type)
+        self.rec_headers = FastWarcHeaders(record.headers)
+        self.http_headers = FastWarcHeaders(record.http_headers) if record.http_headers is not None else None
+        # http headers are already parsed, the reader is positioned at the start of the payload
+        self.raw_stream = record.reader
+
+
+def get_retry_delay(attempt: int, retry_time: int) -> float:
+    r""" Seconds to wait before retrying after `attempt` failures. Full jitter over an exponentially growing
+    upper bound capped at `retry_time`, such that workers failing together do not retry together. """
+    return random.uniform(0, min(retry_time, 2 ** attempt))
+
+
+class RangeReader(io.RawIOBase):
+    r""" Sequentially read a remote file of `size` bytes with range requests of `chunk_size` bytes,
+    keeping up to `prefetch` of them in flight ahead of the reader.
+    `fetch_range(start, end)` must return the bytes between `start` and `end`, both included.
+    Failed and incomplete requests are retried up to `max_retries` times, like downloads.
+    If given, `semaphore` is held during each request to limit concurrent transfers across processes.
+    Seeking is supported, since readers like fastwarc need `tell()`, but seeking outside of the buffered chunk
+    drops the prefetched requests. """
+
+    def __init__(
+        self,
+        fetch_range: Callable[[int, int], bytes],
+        size: int,
+        chunk_size: int = STREAM_CHUNK_SIZE,
+        prefetch: int = STREAM_PREFETCH,
+        retry_time: int = 120,
+        max_retries: int = 8,
+        semaphore=None,
+    ):
+        super().__init__()
+        self.fetch_range = fetch_range
+        self.size = size
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+        self.retry_time = retry_time
+        self.max_retries = max_retries
+        self.semaphore = semaphore
+
+        self.executor = ThreadPoolExecutor(max_workers=prefetch)
+        self.pending = collections.deque()
+        self.position = 0
+        self.next_offset = 0
+        self.buffer = memoryview(b'')
+        self._request_chunks()
+
+    def _request_chunks(self):
+        while len(self.pending) < self.prefetch and self.next_offset < self.size:
+            end = min(self.next_offset + self.chunk_size, self.size)
+            self.pending.append(self.executor.submit(self._fetch, self.next_offset, end - 1))
+            self.next_offset = end
+
+    def _fetch(self, start: int, end: int) -> bytes:
+        attempt = 0
+        while True:
+            try:
+                with self.semaphore or contextlib.nullcontext():
+                    data = self.fetch_range(start, end)
+                if len(data) != end - start + 1:
+                    raise IOError(f'Received {len(data)} bytes instead of {end - start + 1}')
+                return data
+            except Exception:
+                if attempt >= self.max_retries or self.closed:
+                    raise
+                delay = get_retry_delay(attempt, self.retry_time)
+                attempt += 1
+                logger.warning(f'Failed reading bytes {start}-{end}, retrying in {delay:.1f} seconds...', exc_info=True)
+                time.sleep(delay)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        elif whence != io.SEEK_SET:
+            raise ValueError(f'Invalid whence {whence}')
+        if offset < 0:
+            raise ValueError(f'Negative seek position {offset}')
+
+        if self.position <= offset <= self.position + len(self.buffer):
+            self.buffer = self.buffer[offset - self.position:]
+        else:
+            for future in self.pending:
+                future.cancel()
+            self.pending.clear()
+            self.buffer = memoryview(b'')
+            self.next_offset = offset
+            self._request_chunks()
+        self.position = offset
+        return offset
+
+    def readinto(self, b) -> int:
+        if not self.buffer:
+            if not self.pending:
+                return 0
+            self.buffer = memoryview(self.pending.popleft().result())
+            # only the end of the file may end the stream, an empty chunk before it means a truncated read
+            if not self.buffer:
+                raise IOError(f'Remote file ended before its size of {self.size} bytes')
+            self._request_chunks()
+
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        self.position += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            for future in self.pending:
+                future.cancel()
+            self.executor.shutdown(wait=False)
+        super().close()
+
 
 class DownloadProgress(object):
 
@@ -51,160 +289,545 @@ class DownloadProgress(object):
         name = "Downloading" if name is None else f"Downloading {os.path.split(name)[-1]}"
         self.progress = tqdm(desc=name, total=total, unit="B", unit_scale=True, position=position, disable=disable)
 
+        # update the bar in steps of at least `tick` bytes, callbacks may come from many threads
+        self.tick = max(1024 ** 2, (total or 0) // 200)
+        self.pending = 0
+        self.lock = threading.Lock()
+
     def __enter__(self):
         return self.callback
 
     def callback(self, increment: int):
+        with self.lock:
+            self.pending += increment
+            if self.pending < self.tick:
+                return
+            increment, self.pending = self.pending, 0
         self.progress.update(increment)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.pending:
+            self.progress.update(self.pending)
         self.progress.close()
 
 
 def get_publishing_language(warc_record, article):
     r""" Extracts the publishing language from the record. """
-    if hasattr(article, 'language'):
-        return str(article.language)
-    else:
-        return None
+    language = getattr(article, 'language', None)
+    return None if language is None else str(language)
 
 
-def get_publishing_date(warc_record, article):
-    r""" Extracts the publishing date from the record. """
-    if hasattr(article, 'date_publish'):
-        return parser.parse(article.date_publish) if isinstance(article.date_publish, str) else article.date_publish
-    else:
-        return None
+def get_declared_language(warc_record):
+    r""" Extracts the primary language declared by the record in the Content-Language header or in the html tag,
+    without parsing the article. Returns None if no single language is declared. """
+    if warc_record.http_headers is not None:
+        content_language = warc_record.http_headers.get_header('Content-Language')
+        match = CONTENT_LANGUAGE_PATTERN.fullmatch(content_language.strip()) if content_language else None
+        if match:
+            return match.group(1).lower()
 
+    # the payload is read anyway to parse the article, keep it for later reads
+    payload = warc_record.raw_stream.read()
+    warc_record.raw_stream = io.BytesIO(payload)
 
-def get_remote_index(warc_files_start_date=None, warc_files_end_date=None, bucket_name: str = CC_BASE_BUCKET):
-    r""" Gets the index of news crawl files and returns an array of names. """
+    match = HTML_LANG_PATTERN.search(payload, 0, HTML_LANG_SEARCH_SIZE)
+    return match.group(1).decode('ascii').lower() if match else None
 
-    s3_client = boto3.client('s3')
+
+@functools.lru_cache(maxsize=4096)
+def parse_date(date: str) -> datetime.datetime:
+    r""" Parse a date, trying the much faster ISO 8601 format first. Many articles share the same dates. """
+    try:
+        return datetime.datetime.fromisoformat(date.replace('Z', '+00:00'))
+    except ValueError:
+        return parser.parse(date)
+
+
+def get_publishing_date(warc_record, article):
+    r""" Extracts the publishing date from the record. """
+    date_publish = getattr(article, 'date_publish', None)
+    return parse_date(date_publish) if isinstance(date_publish, str) else date_publish
+
+
+def get_month_prefixes(start_date=None, end_date=None) -> List[str]:
+    r""" Prefixes of the folders of the news files, which are grouped per year and month, in the given period. """
+    return [
+        f'crawl-data/CC-NEWS/{date.year:04d}/{date.month:02d}/'
+        for date in __iterate_by_month(start_date=start_date, end_date=end_date)
+    ]
+
+
+@functools.lru_cache(maxsize=None)
+def get_s3_client(bucket_name: str = CC_BASE_BUCKET):
+    r""" S3 client shared by the whole process, None if `bucket_name` cannot be read. """
+    # enough connections for the concurrent range requests of a download and for listing the bucket
+    s3_client = boto3.client('s3', config=botocore.config.Config(
+        max_pool_connections=max(S3_MAX_CONCURRENCY, LISTING_THREADS),
+        retries={'mode': 'adaptive', 'max_attempts': 10},
+    ))
     # Verify access to commoncrawl bucket
     try:
         s3_client.head_bucket(Bucket=bucket_name)
     except (botocore.exceptions.ClientError, botocore.exceptions.NoCredentialsError):
         logger.info(f'Failed to read {bucket_name} bucket, using monthly WARC file listings')
-        s3_client = None
+        return None
+    return s3_client
+
+
+# clients are not fork safe, child processes create their own
+os.register_at_fork(after_in_child=get_s3_client.cache_clear)
+
+
+def get_warc_timestamp(path: str) -> str:
+    r""" Creation time of a warc file as a `WARC_TIMESTAMP_FORMAT` string, taken from its name. """
+    timestamp = os.path.basename(path).replace('CC-NEWS-', '').split('-')[0]
+    return timestamp if len(timestamp) == 14 and timestamp.isdigit() else INVALID_WARC_TIMESTAMP
+
 
+def get_remote_index(warc_files_start_date=None, warc_files_end_date=None, bucket_name: str = CC_BASE_BUCKET):
+    r""" Gets the index of news crawl files and returns an array of names. """
+    objects, _ = _get_remote_index(
+        warc_files_start_date=warc_files_start_date, warc_files_end_date=warc_files_end_date, bucket_name=bucket_name
+    )
+    return objects
+
+
+def _get_remote_index(
+    warc_files_start_date=None, warc_files_end_date=None, bucket_name: str = CC_BASE_BUCKET
+) -> Tuple[List[str], bool]:
+    r""" Same as `get_remote_index`, also returns whether the listings of all months could be fetched. """
+
+    s3_client = get_s3_client(bucket_name)
     objects = []
+    complete = True
 
     if s3_client:
-        def s3_list_objects(bucket, prefix):
-            response = s3_client.list_objects(Bucket=bucket, Prefix=prefix)
-            if 'Contents' not in response:
-                return []
-            return [x['Key'] for x in response['Contents']]
+        paginator = s3_client.get_paginator('list_objects_v2')
+
+        def s3_list_objects(prefix: str) -> List[str]:
+            logger.debug(f'Listing objects on S3 bucket {bucket_name} and prefix {prefix}')
+            # listings are paginated in pages of at most 1000 keys, also skip the warc.paths.gz listings
+            return [
+                x['Key']
+                for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix)
+                for x in page.get('Contents', [])
+                if x['Key'].endswith('.warc.gz')
+            ]
 
         if warc_files_start_date or warc_files_end_date:
-            # The news files are grouped per year and month in separate folders
-            warc_dates = __iterate_by_month(start_date=warc_files_start_date, end_date=warc_files_end_date)
-            for date in warc_dates:
-                year = date.strftime('%Y')
-                month = date.strftime('%m')
-                prefix = f'crawl-data/CC-NEWS/{year}/{month}/'
-                logger.debug(f'Listing objects on S3 bucket {bucket_name} and prefix {prefix}')
-                objects += s3_list_objects(bucket_name, prefix)
+            prefixes = get_month_prefixes(start_date=warc_files_start_date, end_date=warc_files_end_date)
+            with ThreadPoolExecutor(max_workers=LISTING_THREADS) as executor:
+                for listing in executor.map(s3_list_objects, prefixes):
+                    objects += listing
         else:
-            objects = s3_list_objects(bucket_name, 'crawl-data/CC-NEWS/')
+            objects = s3_list_objects('crawl-data/CC-NEWS/')
 
     else:
-        # The news files are grouped per year and month in separate folders
-        warc_dates = __iterate_by_month(start_date=warc_files_start_date, end_date=warc_files_end_date)
-        for date in warc_dates:
-            year = date.strftime('%Y')
-            month = date.strftime('%m')
-            url = f'{CC_BASE_URL}/crawl-data/CC-NEWS/{year}/{month}/warc.paths.gz'
+        urls = [
+            f'{CC_BASE_URL}/{prefix}warc.paths.gz'
+            for prefix in get_month_prefixes(start_date=warc_files_start_date, end_date=warc_files_end_date)
+        ]
+
+        def fetch_listing(url: str) -> List[str]:
             logger.debug(f'Fetching WARC paths listing {url}')
-            response = requests.get(url)
-            if response:
-                objects += gzip.decompress(response.content).decode('ascii').strip().split('\n')
-            else:
-                logger.info(f'Failed to fetch WARC file list {url}: {response}')
+            # decompress the listing while it is downloaded, without buffering the whole response
+            with HTTP_SESSION.get(url, stream=True, timeout=30) as response:
+                if not response:
+                    logger.info(f'Failed to fetch WARC file list {url}: {response}')
+                    return None
+                with gzip.GzipFile(fileobj=response.raw) as listing:
+                    return [line.decode('ascii').strip() for line in listing if line.strip()]
+
+        with ThreadPoolExecutor(max_workers=LISTING_THREADS) as executor:
+            for listing in executor.map(fetch_listing, urls):
+                if listing is None:
+                    complete = False
+                else:
+                    objects += listing
 
     if warc_files_start_date or warc_files_end_date:
         # Now filter further on day of month, hour, minute
-        objects = [
-            p for p in objects if __date_within_period(
-                __extract_date_from_warc_filename(p),
-                start_date=warc_files_start_date,
-                end_date=warc_files_end_date,
-            )
-        ]
+        # fixed width timestamps compare chronologically as strings, without parsing every file name
+        # like upstream, periods start with the news crawl by default, which also drops files with unexpected names
+        start, end = __common_crawl_start_date.strftime(WARC_TIMESTAMP_FORMAT), '99999999999999'
+        if warc_files_start_date:
+            start = warc_files_start_date.strftime(WARC_TIMESTAMP_FORMAT)
+        if warc_files_end_date:
+            end = warc_files_end_date.strftime(WARC_TIMESTAMP_FORMAT)
+        objects = [p for p in objects if start <= get_warc_timestamp(p) < end]
 
     logger.info(f'Found {len(objects)} WARC files')
 
+    return objects, complete
+
+
+def get_cached_remote_index(
+    cache_directory: str,
+    warc_files_start_date=None,
+    warc_files_end_date=None,
+    bucket_name: str = CC_BASE_BUCKET,
+    ttl: int = INDEX_CACHE_TTL,
+):
+    r""" Same as `get_remote_index` but reuses listings saved in `cache_directory` less than `ttl` seconds ago.
+    Listings missing some months because of failed requests are not saved. """
+    key = repr((
+        warc_files_start_date.isoformat() if warc_files_start_date else None,
+        warc_files_end_date.isoformat() if warc_files_end_date else None,
+        bucket_name,
+    ))
+    cache_filepath = os.path.join(cache_directory, f"{hashlib.sha1(key.encode()).hexdigest()}.json")
+
+    if os.path.exists(cache_filepath) and time.time() - os.path.getmtime(cache_filepath) < ttl:
+        logger.info(f'Using cached listing of WARC files {cache_filepath}')
+        with open(cache_filepath) as fi:
+            return json.load(fi)
+
+    objects, complete = _get_remote_index(
+        warc_files_start_date=warc_files_start_date, warc_files_end_date=warc_files_end_date, bucket_name=bucket_name
+    )
+
+    if not complete:
+        logger.warning('Some WARC file lists could not be fetched, the listing is not cached')
+        return objects
+
+    os.makedirs(cache_directory, exist_ok=True)
+    with open(f"{cache_filepath}.temp", 'w') as fo:
+        json.dump(objects, fo)
+    os.rename(f"{cache_filepath}.temp", cache_filepath)
+
     return objects
 
+
+def interleave_warc_paths(warc_paths: List[str], num_workers: int = None, chunksize: int = None) -> List[str]:
+    r""" Reorder the warc paths such that the contiguous split performed by `datasets` over `num_workers`
+    processes gives to each process chunks of `chunksize` files taken from the whole listing, instead
+    of a single contiguous time span. This balances the load when WARC sizes are skewed over time. """
+    num_workers = num_workers or 1
+    if num_workers <= 1 or len(warc_paths) <= num_workers:
+        return list(warc_paths)
+
+    if chunksize is None:
+        # capped, otherwise long listings would give each worker a few chunks spanning months of data
+        chunksize = min(MAX_CHUNKSIZE, max(1, len(warc_paths) // (num_workers * 4)))
+
+    chunks = [warc_paths[i:i + chunksize] for i in range(0, len(warc_paths), chunksize)]
+    return [path for worker_id in range(num_workers) for chunk in chunks[worker_id::num_workers] for path in chunk]
+
+
+def build_hosts_trie(hosts: List[str] = None) -> Dict:
+    r""" Build a trie over the reversed labels of the hosts, e.g. `news.bbc.co.uk` is stored
+    under the path `uk`, `co`, `bbc`, `news`. Returns None if there are no hosts. """
+    if not hosts:
+        return None
+
+    trie = {}
+    for host in hosts:
+        node = trie
+        for label in reversed(host.lower().strip('.').split('.')):
+            node = node.setdefault(label, {})
+        # labels are never empty, use the empty string to mark the end of a host
+        node[''] = True
+    return trie
+
+
+def match_host(host: str, trie: Dict) -> bool:
+    r""" Whether `host` is one of the hosts in the trie or one of their subdomains. """
+    node = trie
+    for label in reversed(host.split('.')):
+        node = node.get(label)
+        if node is None:
+            return False
+        if '' in node:
+            return True
+    return False
+
+
+def open_warc_file(path_name: str, parallelization: int = 1):
+    r""" Open a local warc file for reading. Gzipped files are decompressed in parallel with rapidgzip or,
+    as a fallback, with isal, if available, and the returned stream contains the uncompressed records. """
+    if path_name.endswith('.gz'):
+        if rapidgzip is not None:
+            return rapidgzip.open(path_name, parallelization=parallelization)
+        if igzip is not None:
+            return igzip.open(path_name, 'rb')
+    return open(path_name, 'rb')
+
+
+def drop_cached_pages(path_name: str):
+    r""" Ask the kernel to drop the cached pages of a file that will not be read again soon, where supported. """
+    if hasattr(os, 'posix_fadvise'):
+        fd = os.open(path_name, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def iterate_warc_records(stream):
+    r""" Iterate over the response records of a warc stream with fastwarc, falling back to warcio. """
+    if USE_FASTWARC:
+        records = FastWarcArchiveIterator(
+            stream, record_types=WarcRecordType.response, parse_http=True, verify_digests=False
+        )
+        for record in records:
+            yield FastWarcRecord(record)
+    else:
+        for record in ArchiveIterator(stream):
+            if record.rec_type == 'response':
+                yield record
+
+
 def from_warc(record, fetch_images: bool = False):
     return NewsPlease.from_warc(record, decode_errors="strict", fetch_images=fetch_images)
 
 
-def on_valid_article_extracted(article: Dict) -> Dict:
+@functools.lru_cache(maxsize=None)
+def get_fields_getter(keys: Tuple[str]) -> Callable:
+    r""" Build a function returning the values of the `keys` attributes of an article as a tuple. """
+    getter = operator.attrgetter(*keys)
+    if len(keys) == 1:
+        return lambda article: (getter(article), )
+    return getter
+
+
+def on_valid_article_extracted(article: Dict, keys: Tuple[str] = KEYS_TO_KEEP) -> Dict:
     r""" This function will be invoked for each article that was extracted successfully
     from the archived data and that satisfies the filter criteria.
     """
     # UUID = hashlib.sha256(article.filename.encode()).hexdigest()[:32]
 
     # keep only interesting fields
-    article = {k: v for k, v in article.__dict__.items() if k in KEYS_TO_KEEP}
+    article = dict(zip(keys, get_fields_getter(keys)(article)))
     # article_dict['uuid'] = UUID
     return article
 
 
+def load_cached_articles(cache_filepath: str) -> List[Dict]:
+    r""" Read the articles of a WARC file previously saved with `save_cached_articles`. """
+    # update modification time to implement least recently used eviction
+    os.utime(cache_filepath)
+    with pa.memory_map(cache_filepath) as source:
+        return pa.ipc.open_file(source).read_all().to_pylist()
+
+
+def save_cached_articles(cache_filepath: str, articles: List[Dict]):
+    r""" Atomically save the articles extracted from a WARC file in arrow format. """
+    table = pa.Table.from_pylist(articles)
+    with pa.OSFile(f"{cache_filepath}.temp", 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.rename(f"{cache_filepath}.temp", cache_filepath)
+
+
+def evict_cached_articles(cache_directory: str, max_size: int):
+    r""" Remove least recently used cached files until the cache directory is smaller than `max_size` bytes. """
+    cached_files = [entry for entry in os.scandir(cache_directory) if entry.name.endswith('.arrow')]
+    cached_files.sort(key=lambda entry: entry.stat().st_mtime)
+
+    total_size = sum(entry.stat().st_size for entry in cached_files)
+    for entry in cached_files:
+        if total_size <= max_size:
+            break
+        logger.debug(f'removing cached articles {entry.path}')
+        total_size -= entry.stat().st_size
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            # already evicted by another process
+            pass
+
+
+def get_remote_metadata(path: str, s3_client=None, bucket_name: str = CC_BASE_BUCKET) -> Tuple[int, str]:
+    r""" Size in bytes and ETag of a remote file, each None if it cannot be retrieved. """
+    try:
+        if s3_client is not None:
+            response = s3_client.head_object(Bucket=bucket_name, Key=path)
+            return response['ContentLength'], response.get('ETag', None)
+
+        response = HTTP_SESSION.head(f"{CC_BASE_URL}/{path}", allow_redirects=True, timeout=30)
+        if not response.ok:
+            return None, None
+        content_length = response.headers.get('content-length', None)
+        return int(content_length) if content_length is not None else None, response.headers.get('etag', None)
+
+    except Exception:
+        logger.debug(f'Could not retrieve metadata of remote file {path}', exc_info=True)
+        return None, None
+
+
+def get_local_etag(local_filepath: str) -> str:
+    r""" ETag of the remote file saved with a downloaded file, None if not available. """
+    try:
+        return os.getxattr(local_filepath, ETAG_XATTR).decode()
+    except (AttributeError, OSError):
+        # extended attributes are not supported by every platform and filesystem
+        return None
+
+
+def set_local_etag(local_filepath: str, etag: str):
+    r""" Save the ETag of the remote file with a downloaded file, if supported. """
+    try:
+        os.setxattr(local_filepath, ETAG_XATTR, etag.encode())
+    except (AttributeError, OSError):
+        pass
+
+
+def open_remote_stream(
+    path: str, s3_client=None, bucket_name: str = CC_BASE_BUCKET, semaphore=None
+) -> io.BufferedReader:
+    r""" Open a remote file for sequential reading without downloading it, from S3 if `s3_client` is given,
+    otherwise over HTTPS. If given, `semaphore` is held during each range request. """
+    if s3_client is not None:
+        size = s3_client.head_object(Bucket=bucket_name, Key=path)['ContentLength']
+
+        def fetch_range(start: int, end: int) -> bytes:
+            return s3_client.get_object(Bucket=bucket_name, Key=path, Range=f"bytes={start}-{end}")['Body'].read()
+
+    else:
+        url = f"{CC_BASE_URL}/{path}"
+        response = HTTP_SESSION.head(url, allow_redirects=True, timeout=30)
+        response.raise_for_status()
+        size = int(response.headers['content-length'])
+
+        def fetch_range(start: int, end: int) -> bytes:
+            response = HTTP_SESSION.get(url, headers={'Range': f"bytes={start}-{end}"}, timeout=60)
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise Exception(f'Range requests are not supported for {url}')
+            return response.content
+
+    return io.BufferedReader(RangeReader(fetch_range, size, semaphore=semaphore), buffer_size=1024 * 1024)
+
+
 def download(
     path: str,
     temporary_directory: str,
     position: int = None,
     retry_time: int = 120,
+    max_retries: int = 8,
     s3_client=None,
     bucket_name: str = CC_BASE_BUCKET,
 ):
-    r""" Download and save a file locally. """
-    local_filename = urllib.parse.quote_plus(path)
+    r""" Download and save a file locally. Failed attempts are retried up to `max_retries` times, waiting
+    a random time before each retry, with an exponentially growing upper bound capped at `retry_time` seconds. """
+    # short fixed length names, the extension is kept to detect compressed files
+    local_filename = hashlib.blake2b(path.encode(), digest_size=16).hexdigest() + os.path.splitext(path)[1]
     local_filepath = os.path.join(temporary_directory, local_filename)
     local_filepath_tmp = os.path.join(temporary_directory, f"{local_filename}.temp")
-
-    # return if file already downloaded successfully
+    # concurrent s3 transfers write parts out of order, such files have holes and are never resumed
+    local_filepath_parts = os.path.join(temporary_directory, f"{local_filename}.parts")
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(local_filepath_parts)
+
+    # files kept by previous versions were named after the escaped remote path, they are checked below like the others
+    # their partial downloads may have been written out of order and are removed
+    legacy_filepath = os.path.join(temporary_directory, urllib.parse.quote_plus(path))
+    if not os.path.exists(local_filepath) and os.path.exists(legacy_filepath):
+        logger.info(f'Renaming previously downloaded file {legacy_filepath} to {local_filepath}')
+        os.rename(legacy_filepath, local_filepath)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(f"{legacy_filepath}.temp")
+
+    # return if file already downloaded successfully, not truncated and not changed remotely since
     if os.path.exists(local_filepath):
-        return local_filepath
-
+        remote_size, remote_etag = get_remote_metadata(path, s3_client=s3_client, bucket_name=bucket_name)
+        local_etag = get_local_etag(local_filepath)
+        if (remote_size is None or os.path.getsize(local_filepath) == remote_size) and (
+            remote_etag is None or local_etag is None or local_etag == remote_etag
+        ):
+            logger.info(f'Reusing previously downloaded file {local_filepath}')
+            return local_filepath
+        logger.info(f'Removing corrupted or outdated file {local_filepath}')
+        os.remove(local_filepath)
+
+    attempt = 0
     while True:
 
         try:
+            # resume from a partial download left by a previous attempt or run, if consistent with the remote file
+            # a temporary file as large as the remote one may have been preallocated by an interrupted run
+            offset = os.path.getsize(local_filepath_tmp) if os.path.exists(local_filepath_tmp) else 0
+            if offset > 0:
+                remote_size, _ = get_remote_metadata(path, s3_client=s3_client, bucket_name=bucket_name)
+                if remote_size is None or offset >= remote_size:
+                    offset = 0
+                else:
+                    logger.info(f'Resuming download of {path} from byte {offset}')
 
             if s3_client is not None:
                 logger.info(f"Downloading file {path} to {local_filepath} with S3")
-                with open(local_filepath_tmp, 'wb') as file_obj:
-                    s3_client.download_fileobj(bucket_name, path, file_obj)
+                if offset > 0:
+                    response = s3_client.get_object(Bucket=bucket_name, Key=path, Range=f'bytes={offset}-')
+                    with open(local_filepath_tmp, 'ab') as file_obj:
+                        for data in response['Body'].iter_chunks(STREAM_CHUNK_SIZE):
+                            file_obj.write(data)
+                else:
+                    try:
+                        with DownloadProgress(position=position) as prog_bar:
+                            with open(local_filepath_parts, 'wb') as file_obj:
+                                s3_client.download_fileobj(
+                                    bucket_name, path, file_obj, Config=S3_TRANSFER_CONFIG, Callback=prog_bar
+                                )
+                    except BaseException:
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(local_filepath_parts)
+                        raise
+                    os.replace(local_filepath_parts, local_filepath_tmp)
 
             else:
                 # download
                 url = f"{CC_BASE_URL}/{path}"
                 logger.info(f'Downloading {path} to {local_filepath_tmp} with HTTPS')
 
-                response = requests.get(url, stream=True)
-                total_size_in_bytes = response.headers.get('content-length', None)
-                total_size_in_bytes = int(total_size_in_bytes) if total_size_in_bytes is not None else total_size_in_bytes
+                headers = {'Range': f'bytes={offset}-'} if offset > 0 else None
+                response = HTTP_SESSION.get(url, stream=True, headers=headers, timeout=60)
+                if response.status_code not in (200, 206):
+                    raise Exception(f'Not OK status code received: {response.status_code}')
 
-                with DownloadProgress(total_size_in_bytes, position=position) as prog_bar:
-                    with open(local_filepath_tmp, 'wb') as fo:
-                        for data in response.iter_content(16 * 1024 * 1024):
-                            prog_bar(len(data))
-                            fo.write(data)
+                # the server may ignore the range and send the whole file
+                if response.status_code != 206:
+                    offset = 0
 
-                if response.status_code != 200:
-                    raise Exception(f'Not OK status code received: {response.status_code}')
+                total_size_in_bytes = response.headers.get('content-length', None)
+                total_size_in_bytes = int(total_size_in_bytes) + offset if total_size_in_bytes is not None else None
+
+                # copy in large blocks, progress is updated by the wrapped reads
+                response.raw.decode_content = True
+                with open(local_filepath_tmp, 'r+b' if offset > 0 else 'wb') as fo:
+                    fo.seek(offset)
+                    # the file is accessed sequentially only, tune the kernel caching and read ahead for it
+                    if hasattr(os, 'posix_fadvise'):
+                        os.posix_fadvise(fo.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                    # reserve the whole file at once to avoid fragmentation, where supported
+                    if total_size_in_bytes and hasattr(os, 'posix_fallocate'):
+                        with contextlib.suppress(OSError):
+                            os.posix_fallocate(fo.fileno(), offset, total_size_in_bytes - offset)
+                    try:
+                        with tqdm.wrapattr(
+                            response.raw, 'read', total=total_size_in_bytes, initial=offset,
+                            desc="Downloading", position=position,
+                        ) as raw:
+                            shutil.copyfileobj(raw, fo, 16 * 1024 * 1024)
+                    finally:
+                        # drop the preallocated space not written, such that a retry resumes from the right byte
+                        fo.truncate()
 
         except Exception:
-            logger.exception(f"A connection error occurred for URL {url}, retrying in {retry_time} seconds...")
-            time.sleep(retry_time)
+            if attempt >= max_retries:
+                raise
+            delay = get_retry_delay(attempt, retry_time)
+            attempt += 1
+            logger.exception(f"A connection error occurred for {path}, retrying in {delay:.1f} seconds...")
+            time.sleep(delay)
         else:
             break
     
     logging.debug("Moving completed temporary file to final location and name.")
     os.rename(local_filepath_tmp, local_filepath)
 
-    logger.info(f'Download completed, local file: {local_filename}')
+    _, remote_etag = get_remote_metadata(path, s3_client=s3_client, bucket_name=bucket_name)
+    if remote_etag is not None:
+        set_local_etag(local_filepath, remote_etag)
+
+    logger.info(f'Download of {path} completed, local file: {local_filename}')
     return local_filepath
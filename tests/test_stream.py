@@ -0,0 +1,80 @@
+import io
+
+import pytest
+
+pytest.importorskip('fastwarc')
+warcio = pytest.importorskip('warcio')
+extractor = pytest.importorskip('datasets_news_please.extractor')
+
+from warcio.statusandheaders import StatusAndHeaders  # noqa: E402
+from warcio.warcwriter import WARCWriter  # noqa: E402
+
+from datasets_news_please import utils  # noqa: E402
+
+
+URLS = [f'https://www.example.com/news/article-{i}.html' for i in range(5)]
+
+
+def build_warc() -> bytes:
+    r""" Gzipped warc file with a request and a response record for each url. """
+    output = io.BytesIO()
+    writer = WARCWriter(output, gzip=True)
+    for url in URLS:
+        request_headers = StatusAndHeaders(f'GET {url} HTTP/1.1', [], is_http_request=True)
+        writer.write_record(
+            writer.create_warc_record(url, 'request', payload=io.BytesIO(b''), http_headers=request_headers)
+        )
+        payload = (
+            f'<html lang="en"><head><title>Title of {url}</title></head>'
+            f'<body><h1>Title of {url}</h1><p>{"Some text of the article. " * 100}</p></body></html>'
+        ).encode()
+        http_headers = StatusAndHeaders('200 OK', [('Content-Type', 'text/html; charset=utf-8')], protocol='HTTP/1.1')
+        writer.write_record(
+            writer.create_warc_record(url, 'response', payload=io.BytesIO(payload), http_headers=http_headers)
+        )
+    return output.getvalue()
+
+
+@pytest.fixture
+def streaming_extractor(monkeypatch, tmp_path):
+    r""" Extractor streaming the local warc file with small range requests, like it would stream a remote one. """
+    data = build_warc()
+
+    def open_remote_stream(path, **kwargs):
+        reader = utils.RangeReader(lambda start, end: data[start:end + 1], len(data), chunk_size=1024, prefetch=4)
+        return io.BufferedReader(reader, buffer_size=4096)
+
+    monkeypatch.setattr(utils, 'USE_FASTWARC', True)
+    monkeypatch.setattr(extractor, 'get_s3_client', lambda bucket_name: None)
+    monkeypatch.setattr(extractor, 'open_remote_stream', open_remote_stream)
+    return extractor.IterableCommonCrawlExtractor(temporary_directory=str(tmp_path), process_id=0, stream=True)
+
+
+def test_range_reader_tell_and_seek():
+    data = bytes(range(256)) * 64
+    reader = utils.RangeReader(lambda start, end: data[start:end + 1], len(data), chunk_size=1000, prefetch=2)
+    with io.BufferedReader(reader, buffer_size=512) as stream:
+        assert stream.seekable()
+        assert stream.read(10) == data[:10]
+        assert stream.tell() == 10
+        stream.seek(5000)
+        assert stream.read(3000) == data[5000:8000]
+        stream.seek(-100, io.SEEK_END)
+        assert stream.read() == data[-100:]
+        stream.seek(0)
+        assert stream.read() == data
+
+
+def test_process_warc_stream_with_fastwarc(streaming_extractor):
+    articles = streaming_extractor.extract_from_commoncrawl(
+        'crawl-data/CC-NEWS/2023/01/CC-NEWS-20230101000000-00000.warc.gz', language=None, fields=('url', )
+    )
+    assert [article['url'] for article in articles] == URLS
+
+
+def test_close_stream_extraction_early(streaming_extractor):
+    articles = streaming_extractor.extract_from_commoncrawl(
+        'crawl-data/CC-NEWS/2023/01/CC-NEWS-20230101000000-00000.warc.gz', language=None, fields=('url', )
+    )
+    assert next(articles)['url'] == URLS[0]
+    articles.close()